@@ -1,6 +1,3 @@
-from becmodel.main import BECModel
-
-
 import logging
 
 
@@ -8,3 +5,13 @@ __version__ = "0.1.0dev0"
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
+
+
+def __getattr__(name):
+    # defer loading the model (and the geospatial libraries it depends on)
+    # until it is first accessed, keeping `import becmodel` lightweight
+    if name == "BECModel":
+        from becmodel.main import BECModel
+
+        return BECModel
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
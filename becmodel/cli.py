@@ -1,11 +1,9 @@
+from pathlib import Path
+
 import click
-import logging
-import sys
 
 from cligj import verbose_opt, quiet_opt
 
-from becmodel import BECModel
-
 
 @click.command()
 @click.option(
@@ -31,22 +29,38 @@ from becmodel import BECModel
     is_flag=True,
     help="Do not write temp files to disk",
 )
-@click.argument("config_file", type=click.Path(exists=True), required=False)
+@click.argument(
+    "config_file",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+    required=False,
+)
 @verbose_opt
 @quiet_opt
 def cli(config_file, overwrite, discard_temp, dry_run, load, verbose, quiet):
-    verbosity = verbose - quiet
-    log_level = max(10, 20 - 10 * verbosity)  # default to INFO log level
-    logging.basicConfig(
-        stream=sys.stderr,
-        level=log_level,
-        format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s",
-    )
-
-    BM = BECModel(config_file)
+    # import the model only after the arguments are parsed so that --help
+    # does not have to load the geospatial libraries
+    from becmodel import BECModel
+    from becmodel import util
+    from becmodel.config import get_default
+
+    util.configure_logging(verbose - quiet)
+
+    # parse the config file once, the model is initialized with the values
+    config = util.load_config(config_file) if config_file else None
+
+    # validate the config and input data without initializing the model
     if dry_run:
+        if config:
+            config = {**get_default(), **config}
+            util.validate_config(config)
+        else:
+            config = get_default()
+        util.load_tables(config)
         click.echo("becmodel: Basic input data validation successful")
-    elif load:
+        return
+
+    BM = BECModel(config)
+    if load:
         BM.load(overwrite=overwrite)
     else:
         BM.load(overwrite=overwrite)
@@ -1,14 +1,14 @@
 # Default config
 # To overwrite these values, initialize becmodel with a config file
-import tempfile
+from types import MappingProxyType
 
-defaultconfig = {
+_defaultconfig = {
     "rulepolys_file": "becmodel.gdb",
     "rulepolys_layer": "rulepolys",
     "elevation": "elevation.xls",
     "becmaster": None,
     "dem": None,
-    "temp_folder": tempfile.mkdtemp(prefix="becmodel-"),
+    "temp_folder": None,
     "out_file": "becmodel.shp",
     "out_layer": "becmodel",
     "cell_size_metres": 50,
@@ -27,7 +27,46 @@ defaultconfig = {
     # Areas to be aggregated/removed via 'high_elevation_removal_threshold'
     # to find Alpine, match beclabel first four characters
     # to find Parkland and Woodland, match beclabel seventh character
-    "high_elevation_removal_threshold_alpine": ["BAFA", "CMA", "IMA"],
-    "high_elevation_removal_threshold_parkland": ["p", "s"],
-    "high_elevation_removal_threshold_woodland": ["w"],
+    "high_elevation_removal_threshold_alpine": ("BAFA", "CMA", "IMA"),
+    "high_elevation_removal_threshold_parkland": ("p", "s"),
+    "high_elevation_removal_threshold_woodland": ("w",),
 }
+
+# defaults are read only, list values are stored as tuples so that
+# a shallow copy (see get_default) is safe to modify
+defaultconfig = MappingProxyType(_defaultconfig)
+
+
+def _parse_tuple(value):
+    """Parse comma separated string (as found in config files) to tuple"""
+    if isinstance(value, str):
+        return tuple(value.split(","))
+    return tuple(value)
+
+
+def _parse_value(value):
+    """Parse "True"/"False" strings to bool, pass other values through"""
+    if value == "True":
+        return True
+    elif value == "False":
+        return False
+    return value
+
+
+def _infer_parser(default):
+    if isinstance(default, int):
+        return int
+    elif isinstance(default, tuple):
+        return _parse_tuple
+    return _parse_value
+
+
+# parser for user supplied values of each config key, based on the default type
+CONFIG_SCHEMA = MappingProxyType(
+    {key: _infer_parser(value) for key, value in _defaultconfig.items()}
+)
+
+
+def get_default():
+    """Return a modifiable copy of the default config"""
+    return dict(defaultconfig)
@@ -1,62 +1,77 @@
 import configparser
+import hashlib
 import os
 from pathlib import Path
 import logging
 import shutil
-from math import ceil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil, sqrt
 from datetime import datetime
-import fiona
+from functools import cached_property
 import rasterio
 from rasterio import features
+from rasterio.transform import Affine
 from rasterio.features import shapes
 from rasterio.warp import transform_bounds
 from rasterio.merge import merge as riomerge
 from osgeo import gdal
 import numpy as np
 import geopandas as gpd
-from geojson import Feature, FeatureCollection
-from skimage.filters.rank import majority
-from shapely.geometry.polygon import Polygon
-from shapely.geometry.multipolygon import MultiPolygon
+import shapely
+from shapely.geometry import shape
 import skimage.morphology as morphology
-import click
+from skimage.segmentation import expand_labels
 from scipy import ndimage
-import subprocess
 
 import bcdata
 from terraincache import TerrainTiles
 
 import becmodel
 from becmodel import util
-from becmodel.config import defaultconfig
+from becmodel.config import defaultconfig, get_default
+from becmodel.util import ConfigError, ConfigValueError
 
 
 LOG = logging.getLogger(__name__)
 
+# version of the arrays cached by BECModel.load(), bump when their content or
+# dtypes change so that caches written by earlier versions are not reused
+LOAD_CACHE_VERSION = 2
 
-class ConfigError(Exception):
-    """Configuration key error"""
+# maximum number of becvalues noise filtered concurrently by postfilter()
+NOISE_FILTER_WORKERS = 8
 
+# number of raster cells (whole rows) classified at a time by BECModel.model()
+CLASSIFY_BLOCK_CELLS = 2 ** 18
 
-class ConfigValueError(Exception):
-    """Configuration value error"""
+# creation options for GeoTIFFs written by becmodel (DEMs and QA rasters)
+GTIFF_PROFILE = {
+    "tiled": True,
+    "blockxsize": 512,
+    "blockysize": 512,
+    "compress": "deflate",
+    "predictor": 2,
+    "num_threads": "ALL_CPUS",
+}
 
 
 class BECModel(object):
     """A class to hold a model's config, data and methods"""
 
-    def __init__(self, config_file=None):
+    def __init__(self, config=None):
         LOG.info("Initializing BEC model v{}".format(becmodel.__version__))
 
-        # load and validate supplied config file
-        if config_file:
-            if not os.path.exists(config_file):
-                raise ConfigValueError(f"File {config_file} does not exist")
-
-            self.read_config(config_file)
+        # load and validate supplied config, either a path to a config file
+        # or a dict of config values already parsed by util.load_config
+        # (an empty dict is valid, it overrides nothing)
+        self.user_config = {}
+        if config is not None:
+            self.read_config(config)
             self.validate_config()
         else:
-            self.config = defaultconfig.copy()
+            self.config = get_default()
 
         # load inputs & validate
         self.data = util.load_tables(self.config)
@@ -64,25 +79,12 @@ class BECModel(object):
         # note start time for config log time stamp
         self.start_time = datetime.now()
 
-    def read_config(self, config_file):
-        """Read provided config file, overwriting default config values"""
-        LOG.info("Loading config from file: %s", config_file)
-        cfg = configparser.ConfigParser()
-        cfg.read(config_file)
-        self.user_config = dict(cfg["CONFIG"])
-
-        # ensure all keys are valid
-        for key in self.user_config:
-            if key not in defaultconfig.keys():
-                raise ConfigError("Config key {} is invalid".format(key))
-
-        # convert configparser strings to int/list where required
-        for key in defaultconfig:
-            if key in self.user_config.keys():
-                if type(defaultconfig[key]) == int:
-                    self.user_config[key] = int(self.user_config[key])
-                elif type(defaultconfig[key]) == list:
-                    self.user_config[key] = self.user_config[key].split(",")
+    def read_config(self, config):
+        """Read provided config file or dict, overwriting default config values"""
+        if isinstance(config, dict):
+            self.user_config = util.parse_config(config)
+        else:
+            self.user_config = util.load_config(config)
 
         # create config from default and provided file
         self.config = {**defaultconfig, **self.user_config}
@@ -92,6 +94,7 @@ class BECModel(object):
 
     def update_config(self, update_dict, reload=False):
         """Update config dictionary, reloading source data if specified"""
+        update_dict = util.parse_config(update_dict)
         self.config.update(update_dict)
         # set config temp_folder to wksp for brevity
         if "temp_folder" in update_dict.keys():
@@ -99,40 +102,20 @@ class BECModel(object):
         self.validate_config()
         if reload:
             self.data = util.load_tables(self.config)
+        self.clear_high_elevation_cache()
+
+    def clear_high_elevation_cache(self):
+        """Discard high elevation rules cached from the current config/data"""
+        for key in (
+            "high_elevation_merges",
+            "high_elevation_types",
+            "high_elevation_dissolves",
+        ):
+            self.__dict__.pop(key, None)
 
     def validate_config(self):
         """Validate provided config and add aspect temp zone definitions"""
-        # validate that required paths exist
-        for key in ["rulepolys_file", "elevation"]:
-            if not os.path.exists(self.config[key]):
-                raise ConfigValueError(
-                    "config {}: {} does not exist".format(key, self.config[key])
-                )
-
-        # validate rule polygon layer exists
-        if self.config["rulepolys_layer"] and self.config[
-            "rulepolys_layer"
-        ] not in fiona.listlayers(self.config["rulepolys_file"]):
-            raise ConfigValueError(
-                "config {}: {} does not exist in {}".format(
-                    key, self.config["rulepolys_layer"], self.config["rulepolys_file"]
-                )
-            )
-        # for alignment to work, cell size must be <= 100m
-        if (
-            self.config["cell_size_metres"] < 25
-            or self.config["cell_size_metres"] > 100
-            or self.config["cell_size_metres"] % 5 != 0
-        ):
-            raise ConfigValueError(
-                "cell size {} invalid - must be a multiple of 5 from 25-100".format(
-                    str(self.config["cell_size_metres"])
-                )
-            )
-        # convert True/False config values to boolean type
-        for key in self.config:
-            if self.config[key] in ["True", "False"]:
-                self.config[key] = self.config[key] == "True"
+        util.validate_config(self.config)
 
         # define aspect zone codes and positions (1=cool, 2=neutral, 3=warm)
         self.aspect_zone_codes = [1, 2, 3, 2, 1]
@@ -154,37 +137,40 @@ class BECModel(object):
             np.mod(np.diff(np.array(self.aspect_zone_midpoints)), 360)
         )
 
-        # validate becmaster is not provided, use table provided in /data
-        if not self.config["becmaster"]:
-            self.config["becmaster"] = os.path.join(
-                os.path.dirname(__file__), "data/bec_biogeoclimatic_catalogue.csv"
-            )
-        if not os.path.exists(self.config["becmaster"]):
-            raise ConfigValueError(
-                "BECMaster {} specified in config does not exist.".format(
-                    self.config["becmaster"]
-                )
-            )
-        # is DEM path provided? If so, validate file exists
-        # (no validation that it actually overlaps the rule polygons, we
-        # will presume that the user has that under control)
-        if self.config["dem"]:
-            if not os.path.exists(self.config["dem"]):
-                raise ConfigValueError(
-                    "DEM file {} specified in config does not exist.".format(
-                        self.config["dem"]
-                    )
-                )
-        if Path(self.config["out_file"]).suffix == ".gpkg":
-            self.config["output_driver"] = "GPKG"
-        elif Path(self.config["out_file"]).suffix == ".shp":
-            self.config["output_driver"] = "ESRI Shapefile"
-        else:
-            raise ConfigValueError(
-                "out_file {} specified in config invalid, output must be .shp or .gpkg".format(
-                    self.config["out_file"]
+        # The model steps through each transition between zones in 10 degree
+        # increments. Note the transition index, step and aspect range of each
+        # step, and precompile a lookup table that classifies aspect (degrees)
+        # into the steps. Aspect values >= 360 are held in the final position
+        # of the table, aspects not classified are assigned len(aspect_steps).
+        self.aspect_steps = np.array(
+            [
+                (
+                    i,
+                    step,
+                    ((self.aspect_zone_midpoints[i] + step) - 5) % 360,
+                    ((self.aspect_zone_midpoints[i] + step) + 5) % 360,
                 )
-            )
+                for i, difference in enumerate(self.aspect_zone_differences)
+                for step in range(0, difference, 10)
+            ],
+            dtype=[
+                ("transition", "u1"),
+                ("step", "i2"),
+                ("aspect_min", "i2"),
+                ("aspect_max", "i2"),
+            ],
+        )
+        # (there are at most ~40 steps, so step indexes fit in uint8)
+        self.aspect_lut = np.full(361, len(self.aspect_steps), dtype=np.uint8)
+        for n, (i, step, aspect_min, aspect_max) in enumerate(
+            self.aspect_steps.tolist()
+        ):
+            # for any aspect classes where min > max (they span 0),
+            # do the >= min part as a separate first step
+            if aspect_min > aspect_max:
+                self.aspect_lut[aspect_min:] = n
+                aspect_min = 0
+            self.aspect_lut[aspect_min:aspect_max] = n
 
     def write_config_log(self):
         """dump configs to file"""
@@ -196,20 +182,22 @@ class BECModel(object):
             # convert config values back to string
             if type(defaultconfig[key]) in (int, bool):
                 configlog["2_USER"][key] = str(self.user_config[key])
-            elif type(defaultconfig[key]) == list:
+            elif type(defaultconfig[key]) == tuple:
                 configlog["2_USER"][key] = ",".join(self.user_config[key])
             else:
                 configlog["2_USER"][key] = str(self.user_config[key])
 
+        # log the values used for the run rather than the defaults, values
+        # such as temp_folder are set when the model is loaded
         configlog["3_DEFAULT"] = {}
         for key in defaultconfig:
             if key not in self.user_config:
                 if type(defaultconfig[key]) in (int, bool):
-                    configlog["3_DEFAULT"][key] = str(defaultconfig[key])
-                elif type(defaultconfig[key]) == list:
-                    configlog["3_DEFAULT"][key] = ",".join(defaultconfig[key])
+                    configlog["3_DEFAULT"][key] = str(self.config[key])
+                elif type(defaultconfig[key]) == tuple:
+                    configlog["3_DEFAULT"][key] = ",".join(self.config[key])
                 else:
-                    configlog["3_DEFAULT"][key] = str(defaultconfig[key])
+                    configlog["3_DEFAULT"][key] = str(self.config[key])
 
         timestamp = self.start_time.isoformat(sep="T", timespec="seconds")
         # windows does not support ISO datestamps (:)
@@ -219,7 +207,7 @@ class BECModel(object):
         with open(config_log, "w") as configfile:
             configlog.write(configfile)
 
-    @property
+    @cached_property
     def high_elevation_merges(self):
         """
         Define a list of valid transitions for the high elevation filter,
@@ -233,130 +221,93 @@ class BECModel(object):
         will be translated to parkland of becvalue=2 if the size of the alpine
         area patch is not above the threshold set in the config.
         """
-        high_elevation_merges = []
-        for rule_poly in self.data["rulepolys"].polygon_number.tolist():
+        elevation = self.data["elevation"]
+        beclabels = elevation.beclabel
+        zone_labels = beclabels.str[:4].str.strip()
+        phase_labels = beclabels.str[6:7].str.strip()
 
-            alpine = (
-                self.data["elevation"]
-                .beclabel[
-                    (self.data["elevation"].polygon_number == rule_poly)
-                    & (
-                        self.data["elevation"]
-                        .beclabel.str[:4]
-                        .str.strip()
-                        .isin(self.config["high_elevation_removal_threshold_alpine"])
-                    )
-                ]
-                .tolist()
-            )
+        # find the first alpine/parkland/woodland beclabel of each rule poly
+        def first_label(mask):
+            return elevation[mask].groupby("polygon_number").beclabel.first().to_dict()
 
-            parkland = (
-                self.data["elevation"]
-                .beclabel[
-                    (self.data["elevation"].polygon_number == rule_poly)
-                    & (
-                        self.data["elevation"]
-                        .beclabel.str[6:7]
-                        .str.strip()
-                        .isin(self.config["high_elevation_removal_threshold_parkland"])
-                    )
-                ]
-                .tolist()
-            )
+        alpine = first_label(
+            zone_labels.isin(self.config["high_elevation_removal_threshold_alpine"])
+        )
+        parkland = first_label(
+            phase_labels.isin(self.config["high_elevation_removal_threshold_parkland"])
+        )
+        woodland = first_label(
+            phase_labels.isin(self.config["high_elevation_removal_threshold_woodland"])
+        )
 
-            woodland = (
-                self.data["elevation"]
-                .beclabel[
-                    (self.data["elevation"].polygon_number == rule_poly)
-                    & (
-                        self.data["elevation"]
-                        .beclabel.str[6:7]
-                        .str.strip()
-                        .isin(self.config["high_elevation_removal_threshold_woodland"])
-                    )
-                ]
-                .tolist()
-            )
+        # find beclabels that can be used for the 'high' class, by rule poly
+        # and first 6 characters of label - where the 7th character of
+        # (right padded) beclabel is " " (not parkland, not woodland)
+        no_phase = beclabels.str.pad(9, side="right").str[6] == " "
+        label6 = beclabels[no_phase].str[:6].rename("label6")
+        high = (
+            elevation[no_phase]
+            .groupby(["polygon_number", label6])
+            .beclabel.first()
+            .to_dict()
+        )
 
+        high_elevation_merges = []
+        for rule_poly in self.data["rulepolys"].polygon_number.tolist():
             # get beclabel used for 'high' class from woodland label
             # if woodland label is not present, use parkland
-            if woodland:
-                source_label = woodland
-            elif parkland and not woodland:
-                source_label = parkland
-
-            # find beclabel used for high class by:
-            # - beclabel is equivalent to first 6 char of soiurce
-            #   woodland/parkland label
-            # - 7th character of (right padded) beclabel is " "
-            #   (not parkland, not woodland)
-            if (parkland and not woodland) or woodland:
-                high = (
-                    self.data["elevation"]
-                    .beclabel[
-                        (self.data["elevation"].polygon_number == rule_poly)
-                        & (
-                            self.data["elevation"].beclabel.str[:6]
-                            == source_label[0][:6]
-                        )
-                        & (
-                            self.data["elevation"]
-                            .beclabel.str.pad(9, side="right")
-                            .str[6]
-                            == " "
-                        )
-                    ]
-                    .tolist()
-                )
+            source_label = woodland.get(rule_poly, parkland.get(rule_poly))
+            if source_label:
+                high_label = high[(rule_poly, source_label[:6])]
 
             # Translate the beclabels into becvalue integers,
             # and write each lookup to the list for the given rule poly
-            if alpine:
+            if rule_poly in alpine:
                 lookup = {
                     "rule": rule_poly,
                     "type": "alpine",
-                    "becvalue": self.becvalue_lookup[alpine[0]],
-                    "becvalue_target": self.becvalue_lookup[parkland[0]],
+                    "becvalue": self.becvalue_lookup[alpine[rule_poly]],
+                    "becvalue_target": self.becvalue_lookup[parkland[rule_poly]],
                 }
                 high_elevation_merges.append(lookup)
 
-            if parkland and woodland:
+            if rule_poly in parkland and rule_poly in woodland:
                 lookup = {
                     "rule": rule_poly,
                     "type": "parkland",
-                    "becvalue": self.becvalue_lookup[parkland[0]],
-                    "becvalue_target": self.becvalue_lookup[woodland[0]],
+                    "becvalue": self.becvalue_lookup[parkland[rule_poly]],
+                    "becvalue_target": self.becvalue_lookup[woodland[rule_poly]],
                 }
                 high_elevation_merges.append(lookup)
 
             # it is possible to not have woodland below parkland, in this case
             # transition to the 'high' when removing parkland
-            elif parkland and not woodland:
+            elif rule_poly in parkland:
                 lookup = {
                     "rule": rule_poly,
                     "type": "parkland",
-                    "becvalue": self.becvalue_lookup[parkland[0]],
-                    "becvalue_target": self.becvalue_lookup[high[0]],
+                    "becvalue": self.becvalue_lookup[parkland[rule_poly]],
+                    "becvalue_target": self.becvalue_lookup[high_label],
                 }
                 high_elevation_merges.append(lookup)
 
-            if woodland:
+            if rule_poly in woodland:
                 lookup = {
                     "rule": rule_poly,
                     "type": "woodland",
-                    "becvalue": self.becvalue_lookup[woodland[0]],
-                    "becvalue_target": self.becvalue_lookup[high[0]],
+                    "becvalue": self.becvalue_lookup[woodland[rule_poly]],
+                    "becvalue_target": self.becvalue_lookup[high_label],
                 }
                 high_elevation_merges.append(lookup)
 
         return high_elevation_merges
 
-    @property
+    @cached_property
     def high_elevation_types(self):
         """Create a list of high elevation types found in the entire project"""
         return list(set([k["type"] for k in self.high_elevation_merges]))
 
-    @property
+    @cached_property
     def high_elevation_dissolves(self):
         """
         Parse the high elevation merge rules to determine becvalues
@@ -412,24 +363,61 @@ class BECModel(object):
 
         return high_elevation_dissolves
 
+    @property
+    def load_key(self):
+        """
+        Hash of the inputs and config values that determine the arrays
+        created by load()
+
+        The rule polygons are hashed by content (geometry WKB and
+        polygon_number) rather than by file stats, as FileGDB directories are
+        not reliably touched when their features are edited. A provided DEM
+        is hashed by file content.
+        """
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update("load-cache-v{}".format(LOAD_CACHE_VERSION).encode())
+        for wkb in shapely.to_wkb(self.data["rulepolys"].geometry.values):
+            digest.update(wkb)
+        digest.update(
+            self.data["rulepolys"].polygon_number.to_numpy(dtype=np.int64).tobytes()
+        )
+        if self.config["dem"]:
+            with open(self.config["dem"], "rb") as f:
+                for block in iter(lambda: f.read(2 ** 20), b""):
+                    digest.update(block)
+        values = [
+            self.config[key]
+            for key in [
+                "rulepolys_layer",
+                "cell_size_metres",
+                "expand_bounds_metres",
+                "aspect_neutral_slope_threshold_percent",
+                "aspect_midpoint_neutral_east_degrees",
+            ]
+        ]
+        digest.update(repr((values, self.data["bounds"])).encode())
+        return digest.hexdigest()
+
     def load(self, overwrite=False):
         """Load input data, do all model calculations and filters"""
         # shortcuts
         config = self.config
         data = self.data
 
+        # create temp folder if not specified
+        if not config["temp_folder"]:
+            config["temp_folder"] = tempfile.mkdtemp(prefix="becmodel-")
+        config["wksp"] = config["temp_folder"]
+
         # note workspace
         LOG.info("Temp data are here: {}".format(self.config["temp_folder"]))
 
         # create dict that maps beclabel to becvalue
-        uniques = (
-            data["elevation"][["beclabel", "becvalue"]]
-            .drop_duplicates()
-            .to_dict("list")
-        )
-        self.becvalue_lookup = {}
-        for i, v in enumerate(uniques["beclabel"]):
-            self.becvalue_lookup[v] = uniques["becvalue"][i]
+        uniques = data["elevation"][["beclabel", "becvalue"]].drop_duplicates()
+        self.becvalue_lookup = dict(zip(uniques.beclabel, uniques.becvalue))
+
+        # high elevation rules depend on the lookup, rebuild on next access
+        self.clear_high_elevation_cache()
 
         # create a reverse lookup
         self.beclabel_lookup = {
@@ -438,6 +426,13 @@ class BECModel(object):
         # add zeros to reverse lookup
         self.beclabel_lookup[0] = None
 
+        # becvalue rasters are a single byte when all becvalues and the three
+        # high elevation aggregates (see postfilter) are < 256
+        if data["becmaster"]["becvalue"].max() + 3 < 256:
+            self.becvalue_dtype = np.uint8
+        else:
+            self.becvalue_dtype = np.uint16
+
         # convert slope dependent filter sizes from m to cells
         self.filtersize_low = ceil(
             (
@@ -451,6 +446,13 @@ class BECModel(object):
                 / config["cell_size_metres"]
             )
         )
+        # majority filter footprints for each filter size
+        self.footprint_low = morphology.rectangle(
+            nrows=self.filtersize_low, ncols=self.filtersize_low
+        )
+        self.footprint_steep = morphology.rectangle(
+            nrows=self.filtersize_steep, ncols=self.filtersize_steep
+        )
 
         # get bounds from gdf and bump out by specified expansion
         bounds = list(data["rulepolys"].geometry.total_bounds)
@@ -474,27 +476,6 @@ class BECModel(object):
         srcpath = os.path.join(config["wksp"], "src")
         Path(srcpath).mkdir(parents=True, exist_ok=True)
 
-        # do bounds extend outside of BC?
-        bounds_ll = transform_bounds("EPSG:3005", "EPSG:4326", *data["bounds"])
-        bounds_gdf = util.bbox2gdf(bounds_ll).set_crs("EPSG:4326")
-
-        # load neighbours
-        # Note that the natural earth dataset is only 1:10m,
-        # buffer it by 2km to be sure it captures the edge of the province
-        nbr = (
-            gpd.read_file(
-                os.path.join(os.path.dirname(__file__), "data/neighbours.geojson")
-            )
-            .dissolve(by="scalerank")
-        )
-        nbr = nbr.to_crs("EPSG:3005").buffer(2000).to_crs("EPSG:4326")
-        neighbours = (
-            gpd.GeoDataFrame(nbr)
-            .rename(columns={0: "geometry"})
-            .set_geometry("geometry")
-        )
-        outside_bc = gpd.overlay(neighbours, bounds_gdf, how="intersection")
-
         # use file based dem if provided in config
         if config["dem"]:
             LOG.info("Using DEM: {}".format(config["dem"]))
@@ -502,6 +483,31 @@ class BECModel(object):
         else:
             self.dempath = os.path.join(srcpath, "dem.tif")
 
+        # if the inputs have not changed since a previous load, skip
+        # DEM processing and rule rasterization by using the cached arrays
+        load_cache = os.path.join(srcpath, "load-{}.npz".format(self.load_key))
+        if os.path.exists(load_cache):
+            LOG.info("Loading cached DEM and rule rasters: {}".format(load_cache))
+            with np.load(load_cache) as cached:
+                for key in ["dem", "slope", "aspect", "ruleimg"]:
+                    data[key] = cached[key]
+                self.transform = Affine(*cached["transform"])
+            self.shape = data["dem"].shape
+            self.data = data
+            return
+
+        # do bounds extend outside of BC?
+        bounds_ll = transform_bounds("EPSG:3005", "EPSG:4326", *data["bounds"])
+        bounds_gdf = util.bbox2gdf(bounds_ll).set_crs("EPSG:4326")
+
+        # load neighbours within the bounds - in the common case where no
+        # neighbour is near the bounds, there is no need to intersect them
+        neighbours = util.load_neighbours(bounds_ll)
+        if neighbours.empty:
+            outside_bc = neighbours
+        else:
+            outside_bc = gpd.overlay(neighbours, bounds_gdf, how="intersection")
+
         # We cache the result of WCS / terraintiles requests, so only
         # rerun if the file is not present
         dem_bc = os.path.join(srcpath, "dem_bc.tif")
@@ -509,7 +515,7 @@ class BECModel(object):
         if not config["dem"]:
 
             # get TRIM dem
-            if not os.path.exists(dem_bc):
+            def get_bc_dem():
                 LOG.info("Downloading and processing BC DEM")
                 # request at native resolution and resample locally
                 # because requesting a bilinear resampled DEM is slow
@@ -519,17 +525,19 @@ class BECModel(object):
                 # resample if "cell_size_metres" is not 25m
                 if config["cell_size_metres"] != 25:
                     LOG.info("Resampling BC DEM")
-                    cmd = [
-                        "gdalwarp",
-                        "-r",
-                        "bilinear",
-                        "-tr",
-                        str(config["cell_size_metres"]),
-                        str(config["cell_size_metres"]),
-                        os.path.join(srcpath, "dem_bc25.tif"),
+                    gdal.Warp(
                         dem_bc,
-                    ]
-                    subprocess.run(cmd)
+                        os.path.join(srcpath, "dem_bc25.tif"),
+                        xRes=config["cell_size_metres"],
+                        yRes=config["cell_size_metres"],
+                        resampleAlg="bilinear",
+                        multithread=True,
+                        warpOptions=["NUM_THREADS=ALL_CPUS"],
+                        creationOptions=[
+                            "{}={}".format(k.upper(), v)
+                            for k, v in GTIFF_PROFILE.items()
+                        ],
+                    )
                 # otherwise, just rename
                 else:
                     LOG.info("xxx")
@@ -539,11 +547,9 @@ class BECModel(object):
                 if outside_bc.empty is True:
                     LOG.info("yyy")
                     os.rename(dem_bc, self.dempath)
-            # get terrain-tiles
-            # - if the bbox does extend outside of BC
-            # - if _exbc file is not already present
-            if not os.path.exists(dem_exbc) and not outside_bc.empty:
 
+            # get terrain-tiles
+            def get_exbc_dem():
                 # find path to cached terrain-tiles
                 if "TERRAINCACHE" in os.environ.keys():
                     terraincache_path = os.environ["TERRAINCACHE"]
@@ -562,11 +568,27 @@ class BECModel(object):
                 )
                 tt.save(out_file=dem_exbc)
 
-                # combine the sources
-                a = rasterio.open(dem_bc)
-                b = rasterio.open(dem_exbc)
-                mosaic, out_trans = riomerge([b, a])
-                out_meta = a.meta.copy()
+            # get the BC dem if not already present, and terrain-tiles
+            # - if the bbox does extend outside of BC
+            # - if _exbc file is not already present
+            # Both are network bound and independent, fetch them concurrently
+            get_bc = not os.path.exists(dem_bc)
+            get_exbc = not os.path.exists(dem_exbc) and not outside_bc.empty
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                jobs = []
+                if get_bc:
+                    jobs.append(executor.submit(get_bc_dem))
+                if get_exbc:
+                    jobs.append(executor.submit(get_exbc_dem))
+                for job in jobs:
+                    job.result()
+
+            if get_exbc:
+                # combine the sources (terrain-tiles take precedence where
+                # both are valid, BC dem fills the gaps)
+                with rasterio.open(dem_bc) as a, rasterio.open(dem_exbc) as b:
+                    mosaic, out_trans = riomerge([b, a])
+                    out_meta = a.meta.copy()
                 out_meta.update(
                     {
                         "driver": "GTiff",
@@ -574,6 +596,7 @@ class BECModel(object):
                         "width": mosaic.shape[2],
                         "transform": out_trans,
                         "crs": "EPSG:3005",
+                        **GTIFF_PROFILE,
                     }
                 )
                 # write merged tiff
@@ -583,32 +606,46 @@ class BECModel(object):
         # ----------------------------------------------------------------
         # DEM processing
         # ----------------------------------------------------------------
-        # load dem into memory and get the shape / transform
-        with rasterio.open(self.dempath) as src:
-            self.shape = src.shape
-            self.transform = src.transform
-            data["dem"] = src.read(1)
-
-        # generate slope and aspect
-        if not os.path.exists(os.path.join(srcpath, "slope.tif")):
-            gdal.DEMProcessing(
-                os.path.join(srcpath, "slope.tif"),
-                self.dempath,
-                "slope",
-                slopeFormat="percent",
-            )
-        if not os.path.exists(os.path.join(srcpath, "aspect.tif")):
-            gdal.DEMProcessing(
-                os.path.join(srcpath, "aspect.tif"), self.dempath, "aspect"
+        # Open the dem once, load it into memory and get the shape / transform.
+        # Slope and aspect are derived from the same handle (in memory, the
+        # arrays are cached with the other load outputs so there is no need
+        # for files), reusing the dem blocks already in the GDAL cache
+        dem_ds = gdal.Open(str(self.dempath))
+        # gdal returns None rather than raising for a missing / corrupt file
+        if dem_ds is None:
+            raise util.DataValueError(
+                "Unable to open DEM {}".format(self.dempath)
             )
+        self.shape = (dem_ds.RasterYSize, dem_ds.RasterXSize)
+        self.transform = Affine.from_gdal(*dem_ds.GetGeoTransform())
+        dem_band = dem_ds.GetRasterBand(1)
+
+        # model() only compares the dem against whole metre elevations, so
+        # hold it as int16 (nodata cells are pushed below any elevation band)
+        data["dem"] = util.dem_to_int16(
+            dem_band.ReadAsArray(), dem_band.GetNoDataValue()
+        )
 
-        # load slope from file
-        with rasterio.open(os.path.join(srcpath, "slope.tif")) as src:
-            data["slope"] = src.read(1)
+        # generate slope and aspect
+        slope_ds = gdal.DEMProcessing(
+            "", dem_ds, "slope", format="MEM", slopeFormat="percent"
+        )
+        slope = slope_ds.GetRasterBand(1).ReadAsArray()
+
+        # slope is only compared against whole percent thresholds (and written
+        # to QA as int16), so hold it as int16 as well. NaN compares as False,
+        # so it is pushed above any threshold
+        slope[np.isnan(slope)] = np.iinfo(np.int16).max
+        data["slope"] = (
+            np.floor(slope, out=slope)
+            .clip(np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+            .astype(np.int16)
+        )
 
-        # load aspect and convert to unsigned integer
-        with rasterio.open(os.path.join(srcpath, "aspect.tif")) as src:
-            data["aspect"] = src.read(1).astype(np.uint16)
+        # convert aspect to unsigned integer
+        aspect_ds = gdal.DEMProcessing("", dem_ds, "aspect", format="MEM")
+        data["aspect"] = aspect_ds.GetRasterBand(1).ReadAsArray().astype(np.uint16)
+        dem_ds = slope_ds = aspect_ds = None
 
         # We consider slopes less that 15% to be neutral.
         # Set aspect to aspect_midpoint_neutral_east (ie, typically 90 degrees)
@@ -619,35 +656,46 @@ class BECModel(object):
         # ----------------------------------------------------------------
         # convert rule polygons to raster and expand the outer rule bounds
         # ----------------------------------------------------------------
-        # load to raster
+        # load to raster (uint8 is sufficient for most projects)
+        if data["rulepolys"].polygon_number.max() <= np.iinfo(np.uint8).max:
+            rule_dtype = np.uint8
+        else:
+            rule_dtype = np.uint16
+        rule_shapes = list(
+            zip(
+                data["rulepolys"].geometry.values,
+                data["rulepolys"].polygon_number.values.astype(rule_dtype),
+            )
+        )
         rules = features.rasterize(
-            (
-                (geom, value)
-                for geom, value in zip(
-                    data["rulepolys"].geometry, data["rulepolys"].polygon_number
-                )
-            ),
+            rule_shapes,
             out_shape=self.shape,
             transform=self.transform,
             all_touched=False,
-            dtype=np.uint16,
+            dtype=rule_dtype,
         )
 
-        # create binary inverted rules image to calc distance from
-        # zero values to a rule poly
-        a = np.where(rules == 0, 1, 0)
-
-        # compute the distance (euclidian distance in cell units)
-        # and also return the index of the nearest rule poly
-        # (allowing us to perform 'Euclidean Allocation')
-        b, c = ndimage.distance_transform_edt(a, return_indices=True)
-
-        # extract only the part of the feature transform within
-        # our expansion distance
+        # Expand the rule polys by the expansion distance, assigning cells to
+        # the nearest rule poly ('Euclidean Allocation').
+        # Cells strictly within the expansion distance are assigned - as
+        # squared distances (in cell units) are integers, this is the same as
+        # a maximum distance of sqrt(expand_bounds_cells ** 2 - 1)
         expand_bounds_cells = ceil(
             (config["expand_bounds_metres"] / config["cell_size_metres"])
         )
-        data["ruleimg"] = np.where(b < expand_bounds_cells, rules[c[0], c[1]], 0)
+        data["ruleimg"] = expand_labels(
+            rules, distance=sqrt(max(expand_bounds_cells ** 2 - 1, 0))
+        )
+
+        # cache the arrays for subsequent loads of the same inputs
+        np.savez(
+            load_cache,
+            dem=data["dem"],
+            slope=data["slope"],
+            aspect=data["aspect"],
+            ruleimg=data["ruleimg"],
+            transform=np.array(self.transform)[:6],
+        )
 
         self.data = data
 
@@ -655,74 +703,108 @@ class BECModel(object):
         """
         Generate initial becvalue raster.
 
-        Create the raster by iterating through elevation table,
-        setting output raster to becvalue for each row where criteria are met
-        by the dem/aspect/rulepolys.
+        The elevation bands defined by the rows of the elevation table are
+        compiled into a table of becvalues indexed by rule polygon, aspect
+        step and elevation bin. The raster is then created by looking up
+        each cell's becvalue in the table.
         """
-        LOG.info("Generating initial becvalue raster:")
+        LOG.info("Generating initial becvalue raster")
         # shortcut
         data = self.data
+        elevation = data["elevation"]
 
         # Create the initial bec model
         # We assign beclabels based on elevation / aspect / rule polygon.
         # Elevations in the source elevation table are stretched across
         # the aspect temperature zones (cool/neutral/warm/neutral/cool) in
         # an effort to smooth out transitions values between aspects
-        data["becinit"] = np.zeros(shape=self.shape, dtype="uint16")
-        # iterate through rows in elevation table
-        elevation_rows = data["elevation"].to_dict("records")
-        with click.progressbar(elevation_rows) as bar:
-            for row in bar:
-                # extract the low/high elevation values for each aspect temp zone
-                cool = (row["cool_low"], row["cool_high"])
-                neutral = (row["neutral_low"], row["neutral_high"])
-                warm = (row["warm_low"], row["warm_high"])
-                # define the four transitions, and iterate through them in
-                # clockwise direction
-                for i, transition in enumerate(
-                    [(cool, neutral), (neutral, warm), (warm, neutral), (neutral, cool)]
-                ):
-                    # calculate elevation step size (m) per degree
-                    low_elev_step_size = (
-                        transition[1][0] - transition[0][0]
-                    ) / self.aspect_zone_differences[i]
-
-                    high_elev_step_size = (
-                        transition[1][1] - transition[0][1]
-                    ) / self.aspect_zone_differences[i]
-
-                    # make 10 degree steps through each transition, essentially
-                    # classifying aspect in 10 degree steps
-                    for step in range(0, self.aspect_zone_differences[i], 10):
-                        aspect_min = ((self.aspect_zone_midpoints[i] + step) - 5) % 360
-                        aspect_max = ((self.aspect_zone_midpoints[i] + step) + 5) % 360
-                        elev_min = transition[0][0] + int(
-                            round((step * low_elev_step_size))
-                        )
-                        elev_max = transition[0][1] + int(
-                            round((step * high_elev_step_size))
-                        )
-
-                        # for any aspect classes where min > max (they span 0),
-                        # do the < 360/0 part as a separate first step
-                        if aspect_min > aspect_max:
-                            data["becinit"][
-                                (data["ruleimg"] == row["polygon_number"])
-                                & (data["aspect"] >= aspect_min)
-                                & (data["dem"] >= elev_min)
-                                & (data["dem"] < elev_max)
-                            ] = self.becvalue_lookup[row["beclabel"]]
-                            # now start at zero
-                            aspect_min = 0
-
-                        # assign becvalues based on rule & min/max elev/aspect
-                        data["becinit"][
-                            (data["ruleimg"] == row["polygon_number"])
-                            & (data["aspect"] >= aspect_min)
-                            & (data["aspect"] < aspect_max)
-                            & (data["dem"] >= elev_min)
-                            & (data["dem"] < elev_max)
-                        ] = self.becvalue_lookup[row["beclabel"]]
+
+        # the final aspect step is for unclassified aspects
+        n_steps = len(self.aspect_steps) + 1
+
+        # lookup the position of each rule polygon in the tables below
+        # (cells outside of the rule polygons point to the final position)
+        polygon_numbers = elevation.polygon_number.unique()
+        n_polys = len(polygon_numbers)
+        rule_lut = np.full(
+            max(int(data["ruleimg"].max()), int(polygon_numbers.max())) + 1,
+            n_polys,
+            dtype=np.int32,
+        )
+        rule_lut[polygon_numbers] = np.arange(n_polys)
+        row_poly = rule_lut[elevation.polygon_number.to_numpy()]
+
+        # find the low/high elevation of each aspect step for each row by
+        # stepping the elevation (m) per degree along the four transitions
+        # (in clockwise direction) between the aspect temperature zones
+        transition = self.aspect_steps["transition"]
+        differences = np.array(self.aspect_zone_differences)[transition][:, None]
+        steps = self.aspect_steps["step"][:, None]
+        cool = elevation[["cool_low", "cool_high"]].to_numpy()
+        neutral = elevation[["neutral_low", "neutral_high"]].to_numpy()
+        warm = elevation[["warm_low", "warm_high"]].to_numpy()
+        start = np.stack([cool, neutral, warm, neutral], axis=1)[:, transition]
+        end = np.stack([neutral, warm, neutral, cool], axis=1)[:, transition]
+        elev = np.zeros((len(elevation), n_steps, 2), dtype=np.int32)
+        elev[:, :-1] = start + np.round(steps * ((end - start) / differences))
+
+        # the elevation band edges of each rule polygon / aspect step
+        # define the elevation bins
+        edges = [
+            [np.unique(elev[row_poly == p, k]) for k in range(n_steps)]
+            for p in range(n_polys)
+        ]
+        n_edges = max(len(e) for poly_edges in edges for e in poly_edges)
+        edge_table = np.full(
+            (n_polys + 1, n_steps, n_edges), np.iinfo(np.int32).max, dtype=np.int32
+        )
+        for p in range(n_polys):
+            for k in range(n_steps):
+                edge_table[p, k, : len(edges[p][k])] = edges[p][k]
+
+        # Fill the table of becvalues. A row covers the bins between its
+        # low and high edges, rows are processed in order so that later
+        # rows take precedence (as when the table was applied row by row)
+        becvalue_table = np.zeros(
+            (n_polys + 1, n_steps, n_edges + 1), dtype=self.becvalue_dtype
+        )
+        becvalues = elevation.beclabel.map(self.becvalue_lookup).to_numpy()
+        for r, p in enumerate(row_poly):
+            for k in range(n_steps):
+                low, high = np.searchsorted(edges[p][k], elev[r, k])
+                becvalue_table[p, k, low + 1 : high + 1] = becvalues[r]
+
+        # Classify the raster in blocks of rows, keeping the per cell
+        # temporaries small enough to stay in cache. Buffers for the edge
+        # comparisons are allocated once and reused for every block / edge
+        edge_columns = np.ascontiguousarray(edge_table.reshape(-1, n_edges).T)
+        becvalue_table = becvalue_table.reshape(-1, n_edges + 1)
+        bin_dtype = np.min_scalar_type(n_edges)
+        block_rows = max(1, CLASSIFY_BLOCK_CELLS // self.shape[1])
+        block_shape = (min(block_rows, self.shape[0]), self.shape[1])
+        edge_buffer = np.empty(block_shape, dtype=edge_columns.dtype)
+        mask_buffer = np.empty(block_shape, dtype=bool)
+        data["becinit"] = np.zeros(shape=self.shape, dtype=self.becvalue_dtype)
+        for i in range(0, self.shape[0], block_rows):
+            rows = slice(i, i + block_rows)
+            dem = data["dem"][rows]
+            edge = edge_buffer[: dem.shape[0]]
+            mask = mask_buffer[: dem.shape[0]]
+
+            # classify aspect into 10 degree steps
+            aspect_step = self.aspect_lut[np.minimum(data["aspect"][rows], 360)]
+
+            # position of each cell in the tables
+            cell = rule_lut[data["ruleimg"][rows]] * n_steps + aspect_step
+
+            # elevation bin of each cell is the count of band edges <= dem
+            elev_bin = np.zeros(dem.shape, dtype=bin_dtype)
+            for edge_column in edge_columns:
+                np.take(edge_column, cell, out=edge)
+                np.greater_equal(dem, edge, out=mask)
+                elev_bin += mask
+
+            data["becinit"][rows] = becvalue_table[cell, elev_bin]
 
         self.data = data
 
@@ -740,7 +822,6 @@ class BECModel(object):
 
         # before performing the majority filter, group high elevation
         # labels across rule polygons (alpine, parkland, woodland)
-        data["becinit_grouped"] = data["becinit"].copy()
 
         # define new becvalues for aggregated high elevation labels
         # generate these dynamically based on current max value because using
@@ -754,46 +835,64 @@ class BECModel(object):
                 "parkland": max_value + 2,
                 "woodland": max_value + 3,
             }
+            # (becvalues are small integers, so lookup the aggregate of each
+            # becvalue in a table rather than searching for them)
+            aggregate_lut = np.arange(
+                max_value + len(high_elevation_aggregates) + 1,
+                dtype=self.becvalue_dtype,
+            )
             for key in high_elevation_aggregates:
                 if key in self.high_elevation_types:
-                    for becvalue in self.high_elevation_dissolves[key]:
-                        data["becinit_grouped"] = np.where(
-                            data["becinit_grouped"] == becvalue,
-                            high_elevation_aggregates[key],
-                            data["becinit_grouped"],
-                        )
+                    aggregate_lut[
+                        np.isin(aggregate_lut, self.high_elevation_dissolves[key])
+                    ] = high_elevation_aggregates[key]
+            # remap all cells in a single pass
+            data["becinit_grouped"] = aggregate_lut.take(data["becinit"])
+        else:
+            data["becinit_grouped"] = data["becinit"].copy()
 
         # ----------------------------------------------------------------
         # majority filter
         # ----------------------------------------------------------------
         LOG.info("Running majority filter")
-        data["majority"] = np.where(
-            data["slope"] < config["majority_filter_steep_slope_threshold_percent"],
-            majority(
-                data["becinit_grouped"],
-                morphology.rectangle(
-                    nrows=self.filtersize_low, ncols=self.filtersize_low
-                ),
-            ),
-            majority(
-                data["becinit_grouped"],
-                morphology.rectangle(
-                    nrows=self.filtersize_steep, ncols=self.filtersize_steep
-                ),
-            ),
+        # rank filters are fastest on low bit depth inputs, so filter a dense
+        # encoding of the becvalues (the encoding is order preserving, so ties
+        # are resolved to the same value as when filtering becvalues directly)
+        values, codes = np.unique(data["becinit_grouped"], return_inverse=True)
+        codes = codes.reshape(self.shape).astype(
+            np.uint8 if len(values) <= 256 else np.uint16
         )
+        # filter low and steep slopes with their own filter size, running
+        # each filter only where required
+        low_slope = (
+            data["slope"] < config["majority_filter_steep_slope_threshold_percent"]
+        )
+        majority_codes = np.zeros_like(codes)
+        util.masked_majority(
+            codes,
+            self.footprint_low,
+            low_slope,
+            majority_codes,
+        )
+        util.masked_majority(
+            codes,
+            self.footprint_steep,
+            ~low_slope,
+            majority_codes,
+        )
+        data["majority"] = values[majority_codes]
 
         # to ungroup the high elevation values while retaining the result of
-        # the majority filter, loop through the rule polygons and re-assign
-        # the becvalues
+        # the majority filter, re-assign the becvalues of each rule polygon
         data["postmajority"] = data["majority"].copy()
-
-        for zone in self.high_elevation_types:
-            for lookup in [r for r in self.high_elevation_merges if r["type"] == zone]:
-                data["postmajority"][
-                    (data["ruleimg"] == lookup["rule"])
-                    & (data["majority"] == high_elevation_aggregates[zone])
-                ] = lookup["becvalue"]
+        util.assign_by_rule_and_value(
+            data["postmajority"],
+            data["ruleimg"],
+            {
+                (r["rule"], high_elevation_aggregates[r["type"]]): r["becvalue"]
+                for r in self.high_elevation_merges
+            },
+        )
 
         # ----------------------------------------------------------------
         # Basic noise filter
@@ -808,24 +907,58 @@ class BECModel(object):
         )
 
         # initialize the output raster for noise filter
-        data["noise"] = np.zeros(shape=self.shape, dtype="uint16")
-
-        # process each non zero becvalues
-        for becvalue in [v for v in self.beclabel_lookup if v != 0]:
+        data["noise"] = np.zeros(shape=self.shape, dtype=self.becvalue_dtype)
+
+        # find the extent of all becvalues in a single pass, each becvalue is
+        # then only processed within its extent. Extents are padded by the
+        # noise threshold - any hole reaching the padded edge of the window
+        # includes the padding and is too large to fill, so the results are
+        # the same as when processing the full raster
+        extents = ndimage.find_objects(data["postmajority"])
+
+        # connectivity of the cells of a zone
+        structure = ndimage.generate_binary_structure(2, config["cell_connectivity"])
+
+        def filter_becvalue(becvalue):
+            rows, cols = extents[becvalue - 1]
+            window = (
+                slice(max(rows.start - noise_threshold, 0), rows.stop + noise_threshold),
+                slice(max(cols.start - noise_threshold, 0), cols.stop + noise_threshold),
+            )
 
             # extract given becvalue
-            X = np.where(data["postmajority"] == becvalue, 1, 0)
+            X = data["postmajority"][window] == becvalue
 
             # fill holes, remove small objects
-            Y = morphology.remove_small_holes(
-                X, noise_threshold, connectivity=config["cell_connectivity"]
-            )
-            Z = morphology.remove_small_objects(
-                Y, noise_threshold, connectivity=config["cell_connectivity"]
-            )
-
-            # insert values into output
-            data["noise"] = np.where(Z != 0, becvalue, data["noise"])
+            return window, util.remove_noise(X, noise_threshold, structure)
+
+        # process each non zero becvalue present, the becvalues are
+        # independent so are filtered concurrently
+        becvalues = [
+            v
+            for v in self.beclabel_lookup
+            if v != 0 and v <= len(extents) and extents[v - 1] is not None
+        ]
+        # each task holds window sized label rasters, so limit the workers and
+        # the number of tasks in flight (results are released as they are
+        # written)
+        workers = min(NOISE_FILTER_WORKERS, os.cpu_count() or 1)
+        pending = deque()
+
+        def write_next():
+            # insert values into output (in order, later becvalues take
+            # precedence as before)
+            becvalue, job = pending.popleft()
+            window, Z = job.result()
+            data["noise"][window][Z] = becvalue
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for becvalue in becvalues:
+                if len(pending) == 2 * workers:
+                    write_next()
+                pending.append((becvalue, executor.submit(filter_becvalue, becvalue)))
+            while pending:
+                write_next()
 
         # ----------------------------------------------------------------
         # Fill holes introduced by noise filter
@@ -839,13 +972,19 @@ class BECModel(object):
         # polys only, otherwise the results bleed to the edges of the extent
         # (note that this removes need for area closing, edges are filled too)
         # ----------------------------------------------------------------
-        a = np.where(data["noise"] == 0, 1, 0)
-        b, c = ndimage.distance_transform_edt(a, return_indices=True)
-        data["noise_fill"] = np.where(
-            (data["noise"] == 0) & (data["ruleimg"] != 0),
-            data["noise"][c[0], c[1]],
-            data["noise"],
-        )
+        # cells within the (expanded) rule polygons, used again when polygonizing
+        in_rules = data["ruleimg"] != 0
+        holes = data["noise"] == 0
+        fill = holes & in_rules
+        data["noise_fill"] = data["noise"].copy()
+        # the distance transform is only required if there are holes to fill
+        # (and there must be something to fill them with)
+        if fill.any() and not holes.all():
+            c = ndimage.distance_transform_edt(
+                holes, return_distances=False, return_indices=True
+            )
+            # gather the nearest becvalue only for the holes to be filled
+            data["noise_fill"][fill] = data["noise"][c[0][fill], c[1][fill]]
 
         # ----------------------------------------------------------------
         # High elevation noise removal
@@ -867,6 +1006,11 @@ class BECModel(object):
             # Because we are finding noise by aggregating and finding holes,
             # iterate through all but the lowest high elevation type.
             dissolve_types = list(self.high_elevation_dissolves.keys())
+
+            # table of the becvalues to aggregate, covering every value of
+            # the highelev dtype so that it is allocated once
+            agg_lut = np.zeros(np.iinfo(data["highelev"].dtype).max + 1, dtype=bool)
+            X = np.empty(self.shape, dtype=bool)
             for i, highelev_type in enumerate(dissolve_types[:-1]):
                 LOG.info(
                     "Running high_elevation_removal_threshold on {}".format(
@@ -884,69 +1028,67 @@ class BECModel(object):
                 to_agg = self.high_elevation_dissolves[dissolve_types[i + 1]]
 
                 # aggregate the areas, creating a boolean array
-                X = np.isin(data["highelev"], to_agg)
+                # (becvalues are small integers, look them up in a table)
+                agg_lut[:] = False
+                agg_lut[list(to_agg)] = True
+                np.take(agg_lut, data["highelev"], out=X)
 
-                # remove small holes (below our threshold) within the boolean array
-                Y = morphology.remove_small_holes(
-                    X,
-                    high_elevation_removal_threshold,
-                    connectivity=config["cell_connectivity"],
-                )
-
-                # find the difference
-                # (just fill the holes, don't write the entire zones)
-                Z = np.where((X == 0) & (Y == 1), 1, 0)
+                # find the small holes (below our threshold) within the boolean
+                # array (just fill the holes, don't write the entire zones)
+                Z = util.small_holes(X, high_elevation_removal_threshold, structure)
 
-                # note that for QA, we could add  X/Y/Z arrays to the data dict
+                # note that for QA, we could add X/Z arrays to the data dict
                 # something like this, - they'll get written to temp
-                # data[highelev_type+"_X"] = X
-                # data[highelev_type+"_Y"] = Y
-
-                # remove the small areas in the output image by looping through
-                # the merges for the given type, this iterates through the
-                # rule polygons.
-                for merge in [
-                    m for m in self.high_elevation_merges if m["type"] == highelev_type
-                ]:
-                    data["highelev"] = np.where(
-                        (Z == 1) & (data["ruleimg"] == merge["rule"]),
-                        merge["becvalue_target"],
-                        data["highelev"],
-                    )
+                # data[highelev_type+"_X"] = X.copy()
+                # data[highelev_type+"_Z"] = Z
+
+                # remove the small areas in the output image, assigning the
+                # merge target for the given type of each rule polygon
+                util.assign_by_rule(
+                    data["highelev"],
+                    Z,
+                    data["ruleimg"],
+                    {
+                        m["rule"]: m["becvalue_target"]
+                        for m in self.high_elevation_merges
+                        if m["type"] == highelev_type
+                    },
+                )
 
         # ----------------------------------------------------------------
         # Convert to poly
+        # Only cells within the (expanded) rule polygons are polygonized, the
+        # output is clipped to the rule polygons so anything else is dropped
         # ----------------------------------------------------------------
-        fc = FeatureCollection(
-            [
-                Feature(geometry=s, properties={"becvalue": v})
-                for i, (s, v) in enumerate(
-                    shapes(
-                        data["highelev"],
-                        transform=self.transform,
-                        connectivity=(config["cell_connectivity"] * 4),
-                    )
-                )
-            ]
+        geoms = []
+        becvalues = []
+        for geom, becvalue in shapes(
+            data["highelev"],
+            mask=in_rules,
+            transform=self.transform,
+            connectivity=(config["cell_connectivity"] * 4),
+        ):
+            geoms.append(shape(geom))
+            becvalues.append(becvalue)
+        data["becvalue_polys"] = gpd.GeoDataFrame(
+            {"becvalue": becvalues}, geometry=geoms, crs="EPSG:3005"
         )
-        data["becvalue_polys"] = gpd.GeoDataFrame.from_features(fc)
 
         # add beclabel column to output polygons
         data["becvalue_polys"]["BGC_LABEL"] = data["becvalue_polys"]["becvalue"].map(
             self.beclabel_lookup
         )
 
-        # set crs
-        data["becvalue_polys"].crs = "EPSG:3005"
-
         # clip to aggregated rule polygons
         # (buffer the dissolved rules out and in to ensure no small holes
         # are created by dissolve due to precision errors)
-        data["rulepolys"]["rules"] = 1
-        X = data["rulepolys"].dissolve(by="rules").buffer(0.01).buffer(-0.01)
-        Y = gpd.GeoDataFrame(X).rename(columns={0: "geometry"}).set_geometry("geometry")
-        data["becvalue_polys"] = gpd.overlay(
-            data["becvalue_polys"], Y, how="intersection"
+        rules = (
+            shapely.union_all(data["rulepolys"].geometry.values)
+            .buffer(0.01)
+            .buffer(-0.01)
+        )
+        data["becvalue_polys"] = gpd.clip(
+            data["becvalue_polys"], rules, keep_geom_type=True
         )
 
         # add area_ha column
@@ -974,23 +1116,57 @@ class BECModel(object):
             qa_dumps = [d for d in self.data.keys() if type(self.data[d]) == np.ndarray]
             # read DEM to get crs / width / height etc
             with rasterio.open(self.dempath) as src:
-                for i, raster in enumerate(qa_dumps):
-                    out_qa_tif = os.path.join(
-                        self.config["wksp"], str(i).zfill(2) + "_" + raster + ".tif"
-                    )
-                    with rasterio.open(
-                        out_qa_tif,
-                        "w",
-                        driver="GTiff",
-                        dtype=rasterio.int16,
-                        count=1,
-                        width=src.width,
-                        height=src.height,
-                        crs=src.crs,
-                        transform=src.transform,
-                        nodata=src.nodata,
-                    ) as dst:
-                        dst.write(self.data[raster].astype(np.int16), indexes=1)
+                profile = {
+                    "driver": "GTiff",
+                    "count": 1,
+                    "width": src.width,
+                    "height": src.height,
+                    "crs": src.crs,
+                    "transform": src.transform,
+                    **GTIFF_PROFILE,
+                }
+                nodata = src.nodata
+
+            def write_qa(i, raster):
+                out_qa_tif = os.path.join(
+                    self.config["wksp"], str(i).zfill(2) + "_" + raster + ".tif"
+                )
+                # write integer arrays as is, other arrays as int16
+                array = self.data[raster]
+                if array.dtype == bool:
+                    array = array.view(np.uint8)
+                if array.dtype in (np.uint8, np.uint16, np.int16):
+                    dtype = array.dtype
+                else:
+                    dtype = np.dtype(np.int16)
+                if nodata is not None and not rasterio.dtypes.in_dtype_range(
+                    nodata, dtype
+                ):
+                    band_nodata = None
+                else:
+                    band_nodata = nodata
+                with rasterio.open(
+                    out_qa_tif, "w", dtype=dtype, nodata=band_nodata, **profile
+                ) as dst:
+                    if array.dtype == dtype:
+                        dst.write(array, indexes=1)
+                    else:
+                        # cast a block at a time rather than copying the array
+                        for _, window in dst.block_windows(1):
+                            dst.write(
+                                array[window.toslices()].astype(dtype),
+                                indexes=1,
+                                window=window,
+                            )
+
+            # each file is written with its own dataset handle, so the files
+            # can be compressed and written concurrently
+            with ThreadPoolExecutor(max_workers=min(8, len(qa_dumps) or 1)) as executor:
+                for job in [
+                    executor.submit(write_qa, i, raster)
+                    for i, raster in enumerate(qa_dumps)
+                ]:
+                    job.result()
 
             # remind user where to find QA data
             LOG.info("QA files are here: {}".format(self.config["temp_folder"]))
@@ -1000,28 +1176,35 @@ class BECModel(object):
             columns=["becvalue"]
         )
 
-        # define output schema
-        schema = {
-            "geometry": "MultiPolygon",
-            "properties": {"BGC_LABEL": "str:9", "AREA_HA": "float:16"},
-        }
-
-        # cast all features to multipolygon so that they match schema above
+        # cast all features to multipolygon so that the output layer has a
+        # single geometry type
         # https://gis.stackexchange.com/questions/311320/casting-geometry-to-multi-using-geopandas
-        self.data["becvalue_polys"]["geometry"] = [
-            MultiPolygon([feature]) if type(feature) == Polygon else feature
-            for feature in self.data["becvalue_polys"]["geometry"]
-        ]
+        geoms = np.asarray(self.data["becvalue_polys"].geometry.array)
+        is_polygon = shapely.get_type_id(geoms) == shapely.GeometryType.POLYGON
+        if is_polygon.any():
+            geoms[is_polygon] = shapely.multipolygons(geoms[is_polygon][:, np.newaxis])
+        self.data["becvalue_polys"]["geometry"] = gpd.GeoSeries(
+            geoms,
+            index=self.data["becvalue_polys"].index,
+            crs=self.data["becvalue_polys"].crs,
+        )
 
         # write output vectors to file
         # Supported formats are shapefile or geopackage, indicated by file
         # extension in config[out_file].
         # **note that config[out_layer] is ignored if writing to shapefile**
+        # (shapefile fields are resized to fit the values written)
+        if self.config["output_driver"] == "ESRI Shapefile":
+            layer_options = {"RESIZE": "YES"}
+        else:
+            layer_options = None
         self.data["becvalue_polys"].to_file(
             self.config["out_file"],
             layer=self.config["out_layer"],
-            schema=schema,
             driver=self.config["output_driver"],
+            engine="pyogrio",
+            geometry_type="MultiPolygon",
+            layer_options=layer_options,
         )
 
         # dump config settings to file
@@ -1,4 +1,10 @@
 
+import configparser
+import hashlib
+import os
+import pickle
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from math import trunc
 from pathlib import Path
 
@@ -9,15 +15,154 @@ from shapely.geometry import Point, Polygon
 import pandas as pd
 import numpy as np
 import geopandas as gpd
+import pyogrio
+from skimage.filters.rank import majority
+from scipy import ndimage
+
+from becmodel import __version__
+from becmodel.config import CONFIG_SCHEMA, defaultconfig
 
 
 LOG = logging.getLogger(__name__)
+LOG_FORMATTER = logging.Formatter("%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
+_log_handler = None
+
+
+# version of the cached neighbours file written by load_neighbours, bump when
+# the processing of the source data changes
+NEIGHBOURS_CACHE_VERSION = 1
+
+
+class ConfigError(Exception):
+    """Configuration key error"""
+
+
+class ConfigValueError(Exception):
+    """Configuration value error"""
 
 
 class DataValueError(Exception):
     """error in input dataset"""
 
 
+def configure_logging(verbosity=0):
+    """Log to stderr, at INFO level by default
+
+    The handler is only created on the first call, and only if the root
+    logger has no handlers yet (eg logging already configured by an
+    application using becmodel), so records are never emitted twice.
+    Repeated calls just set the log level.
+    """
+    global _log_handler
+    root = logging.getLogger()
+    if _log_handler is None and not root.handlers:
+        _log_handler = logging.StreamHandler(sys.stderr)
+        _log_handler.setFormatter(LOG_FORMATTER)
+        root.addHandler(_log_handler)
+    root.setLevel(max(10, 20 - 10 * verbosity))
+
+
+def cache_dir():
+    """Return path to the user level becmodel cache folder"""
+    return os.path.join(os.path.expanduser("~"), ".cache", "becmodel")
+
+
+def load_config(config_file):
+    """Read provided config file, returning dict of user supplied values
+
+    Parsed configs are cached (keyed by path, mtime and size of the config
+    file, the becmodel version and the config schema) so that repeated runs
+    with an unmodified file do not re-parse it.
+    Set environment variable BECMODEL_CONFIG_CACHE=0 to disable the cache.
+    """
+    LOG.info("Loading config from file: %s", config_file)
+    try:
+        stat = os.stat(config_file)
+    except FileNotFoundError:
+        raise ConfigValueError(f"File {config_file} does not exist")
+    schema = repr(
+        [
+            (key, parser.__name__, defaultconfig[key])
+            for key, parser in CONFIG_SCHEMA.items()
+        ]
+    )
+    key = hashlib.blake2b(
+        f"{os.path.abspath(config_file)}|{stat.st_mtime_ns}|{stat.st_size}|"
+        f"{__version__}|{schema}".encode()
+    ).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir(), f"config-{key}.pkl")
+    use_cache = os.environ.get("BECMODEL_CONFIG_CACHE") != "0"
+    if use_cache and os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+
+    cfg = configparser.ConfigParser()
+    cfg.read(config_file)
+    user_config = parse_config(dict(cfg["CONFIG"]))
+
+    if use_cache:
+        try:
+            Path(cache_dir()).mkdir(parents=True, exist_ok=True)
+            with open(cache_file, "wb") as f:
+                pickle.dump(user_config, f)
+        except OSError:
+            LOG.debug("Unable to write config cache %s", cache_file)
+
+    return user_config
+
+
+def parse_config(user_config):
+    """Validate keys of user supplied config values and parse the values to
+    the types used by becmodel (int, tuple, bool)
+    """
+    for key in user_config:
+        if key not in CONFIG_SCHEMA:
+            raise ConfigError("Config key {} is invalid".format(key))
+    return {key: CONFIG_SCHEMA[key](value) for key, value in user_config.items()}
+
+
+def load_neighbours(bbox):
+    """Return buffered neighbouring jurisdictions intersecting bbox (EPSG:4326)
+
+    The natural earth dataset is only 1:10m, it is buffered by 2km to be sure
+    it captures the edge of the province. The dissolved and buffered
+    neighbours are written to the becmodel cache folder on first use, so
+    subsequent runs only read the features within bbox from the cache.
+    """
+    src = os.path.join(os.path.dirname(__file__), "data/neighbours.geojson")
+    cached = os.path.join(
+        cache_dir(), "neighbours-buffered-v{}.fgb".format(NEIGHBOURS_CACHE_VERSION)
+    )
+    if (
+        not os.path.exists(cached)
+        or os.stat(cached).st_mtime_ns < os.stat(src).st_mtime_ns
+    ):
+        nbr = gpd.read_file(src, engine="pyogrio", use_arrow=True).dissolve(
+            by="scalerank"
+        )
+        nbr = nbr.to_crs("EPSG:3005").buffer(2000).to_crs("EPSG:4326")
+        neighbours = (
+            gpd.GeoDataFrame(nbr)
+            .rename(columns={0: "geometry"})
+            .set_geometry("geometry")
+            .reset_index()
+        )
+        # write to a temp file and move it into place, so that an interrupted
+        # write never leaves a partial cache file
+        tmp = "{}.{}.tmp.fgb".format(cached, os.getpid())
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            neighbours.to_file(tmp, driver="FlatGeobuf", engine="pyogrio")
+            os.replace(tmp, cached)
+        except (OSError, RuntimeError):
+            # pyogrio errors (DataSourceError etc) are RuntimeErrors
+            LOG.debug("Unable to cache neighbours to {}".format(cached))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return neighbours.cx[bbox[0] : bbox[2], bbox[1] : bbox[3]]
+    return gpd.read_file(cached, bbox=tuple(bbox), engine="pyogrio", use_arrow=True)
+
+
 def align(bounds):
     """
     Adjust input bounds to align with Hectares BC raster
@@ -28,6 +173,68 @@ def align(bounds):
     return (ll[0], ll[1], ur[0], ur[1])
 
 
+def validate_config(config):
+    """Validate config values and paths, setting derived values in place"""
+    # validate that required paths exist
+    for key in ["rulepolys_file", "elevation"]:
+        if not os.path.exists(config[key]):
+            raise ConfigValueError(
+                "config {}: {} does not exist".format(key, config[key])
+            )
+
+    # validate rule polygon layer exists
+    if config["rulepolys_layer"] and config[
+        "rulepolys_layer"
+    ] not in pyogrio.list_layers(config["rulepolys_file"])[:, 0]:
+        raise ConfigValueError(
+            "config {}: {} does not exist in {}".format(
+                key, config["rulepolys_layer"], config["rulepolys_file"]
+            )
+        )
+    # for alignment to work, cell size must be <= 100m
+    if (
+        config["cell_size_metres"] < 25
+        or config["cell_size_metres"] > 100
+        or config["cell_size_metres"] % 5 != 0
+    ):
+        raise ConfigValueError(
+            "cell size {} invalid - must be a multiple of 5 from 25-100".format(
+                str(config["cell_size_metres"])
+            )
+        )
+    # validate becmaster is not provided, use table provided in /data
+    if not config["becmaster"]:
+        config["becmaster"] = os.path.join(
+            os.path.dirname(__file__), "data/bec_biogeoclimatic_catalogue.csv"
+        )
+    if not os.path.exists(config["becmaster"]):
+        raise ConfigValueError(
+            "BECMaster {} specified in config does not exist.".format(
+                config["becmaster"]
+            )
+        )
+    # is DEM path provided? If so, validate file exists
+    # (no validation that it actually overlaps the rule polygons, we
+    # will presume that the user has that under control)
+    if config["dem"]:
+        if not os.path.exists(config["dem"]):
+            raise ConfigValueError(
+                "DEM file {} specified in config does not exist.".format(
+                    config["dem"]
+                )
+            )
+    if Path(config["out_file"]).suffix == ".gpkg":
+        config["output_driver"] = "GPKG"
+    elif Path(config["out_file"]).suffix == ".shp":
+        config["output_driver"] = "ESRI Shapefile"
+    else:
+        raise ConfigValueError(
+            "out_file {} specified in config invalid, output must be .shp or .gpkg".format(
+                config["out_file"]
+            )
+        )
+
+
 def load_tables(config):
     """load data from files specified in config and validate
     """
@@ -142,7 +349,10 @@ def load_tables(config):
 
         # -- rule polys
         data["rulepolys"] = gpd.read_file(
-            config["rulepolys_file"], layer=config["rulepolys_layer"]
+            config["rulepolys_file"],
+            layer=config["rulepolys_layer"],
+            engine="pyogrio",
+            use_arrow=True,
         )
         # -- reproject if necessary
         if not data["rulepolys"].crs:
@@ -245,6 +455,185 @@ def multi2single(gdf):
     return gdf_singlepoly
 
 
+def dem_to_int16(dem, nodata=None):
+    """Return dem as int16 for comparison with whole metre elevations
+
+    Float values are floored so that comparisons with integers are unchanged.
+    Cells that are not finite, equal to nodata or outside of the int16 range
+    are set to the int16 minimum, below any elevation band.
+    """
+    info = np.iinfo(np.int16)
+    if dem.dtype == np.int16:
+        invalid = np.zeros(dem.shape, dtype=bool)
+    else:
+        invalid = (dem < info.min) | (dem > info.max)
+        if np.issubdtype(dem.dtype, np.floating):
+            invalid |= ~np.isfinite(dem)
+    if nodata is not None:
+        invalid |= dem == nodata
+    if np.issubdtype(dem.dtype, np.floating):
+        dem = np.floor(dem)
+    return np.where(invalid, info.min, dem).astype(np.int16)
+
+
+def assign_by_rule(image, mask, ruleimg, rule_values):
+    """Set cells of image within mask to the value given for their rule polygon
+
+    rule_values is a dict of rule polygon number: value, cells within mask
+    belonging to rule polygons not in rule_values are not modified.
+    Modifies image in place.
+    """
+    if not rule_values:
+        return
+    size = max(int(ruleimg.max()), max(rule_values)) + 1
+    lookup = np.zeros(size, dtype=image.dtype)
+    valid = np.zeros(size, dtype=bool)
+    lookup[list(rule_values)] = list(rule_values.values())
+    valid[list(rule_values)] = True
+    rules = ruleimg[mask]
+    mask = mask.copy()
+    mask[mask] = valid[rules]
+    image[mask] = lookup[ruleimg[mask]]
+
+
+def assign_by_rule_and_value(image, ruleimg, lookup):
+    """Reassign image values by rule polygon
+
+    lookup is a dict of (rule polygon number, value): new value, cells of
+    image holding value within the rule polygon are set to new value.
+    Other cells are not modified. Modifies image in place.
+    """
+    if not lookup:
+        return
+    # pack (rule, value) pairs into sorted uint32 keys
+    keys = np.array(
+        [(rule << 16) | value for rule, value in lookup], dtype=np.uint32
+    )
+    order = np.argsort(keys)
+    keys = keys[order]
+    new_values = np.array(list(lookup.values()), dtype=image.dtype)[order]
+
+    # only cells holding a value to be reassigned are looked up
+    mask = np.isin(image, [value for rule, value in lookup])
+    packed = (ruleimg[mask].astype(np.uint32) << 16) | image[mask].astype(np.uint32)
+    idx = np.searchsorted(keys, packed).clip(max=len(keys) - 1)
+    hit = keys[idx] == packed
+    mask[mask] = hit
+    image[mask] = new_values[idx[hit]]
+
+
+def small_holes(mask, threshold, structure):
+    """Return the holes of less than threshold cells in boolean mask
+
+    Holes are the connected regions of False cells (including regions
+    touching the edge of mask), connectivity is defined by structure.
+    """
+    labels, n = ndimage.label(~mask, structure)
+    small = np.bincount(labels.ravel()) < threshold
+    small[0] = False
+    return small[labels]
+
+
+def remove_noise(mask, threshold, structure):
+    """Fill holes and then remove objects of less than threshold cells from
+    boolean mask, connectivity is defined by structure
+
+    Holes / objects of exactly threshold cells are retained.
+    """
+    # fill holes
+    filled = mask | small_holes(mask, threshold, structure)
+
+    # remove small objects
+    labels, n = ndimage.label(filled, structure)
+    keep = np.bincount(labels.ravel()) >= threshold
+    keep[0] = False
+    return keep[labels]
+
+
+def count_majority(image, size, values):
+    """Majority filter of image over a rectangle of given (rows, cols) size
+
+    The rectangle for a cell at (r, c) starts at (r - rows // 2, c - cols // 2).
+    Only cells within image are counted and ties resolve to the lowest value,
+    as with the skimage rank filter used for other tiles in masked_majority.
+    The cells of each value are counted with separable box sums rather than
+    a moving histogram, this is faster when there are few values.
+    values must be sorted and include every value in image.
+    """
+    out = np.zeros_like(image)
+    votes = np.zeros(image.shape, dtype=np.uint16)
+    row_counts = np.empty(image.shape, dtype=np.uint16)
+    counts = np.empty(image.shape, dtype=np.uint16)
+    for value in values:
+        ndimage.correlate1d(
+            (image == value).view(np.uint8),
+            np.ones(size[0]),
+            axis=0,
+            output=row_counts,
+            mode="constant",
+        )
+        ndimage.correlate1d(
+            row_counts, np.ones(size[1]), axis=1, output=counts, mode="constant"
+        )
+        # ties resolve to the lowest value, as with skimage
+        more = counts > votes
+        votes[more] = counts[more]
+        out[more] = value
+    return out
+
+
+def masked_majority(image, footprint, mask, out, tile_size=512, count_values=32):
+    """Write majority filter of image to out, for cells within mask only
+
+    The filter is only run on tiles (within the extent of mask) containing
+    cells within mask. Tiles are padded by the footprint size so that results
+    are identical to filtering the full image. Tiles with at most count_values
+    distinct values are filtered with count_majority when the footprint is
+    a rectangle. Tiles are independent, so they are filtered concurrently.
+    """
+    rectangle = bool(footprint.all())
+    # only tile the extent of the mask
+    extent = ndimage.find_objects(mask.view(np.uint8))
+    if not extent:
+        return
+    rows, cols = extent[0]
+    pad_rows, pad_cols = footprint.shape
+    tiles = [
+        (
+            slice(row, min(row + tile_size, rows.stop)),
+            slice(col, min(col + tile_size, cols.stop)),
+        )
+        for row in range(rows.start, rows.stop, tile_size)
+        for col in range(cols.start, cols.stop, tile_size)
+    ]
+    tiles = [tile for tile in tiles if mask[tile].any()]
+
+    def filter_tile(tile):
+        row0 = max(tile[0].start - pad_rows, 0)
+        col0 = max(tile[1].start - pad_cols, 0)
+        window = (
+            slice(row0, tile[0].stop + pad_rows),
+            slice(col0, tile[1].stop + pad_cols),
+        )
+        window_image = image[window]
+        values = np.flatnonzero(np.bincount(window_image.ravel()))
+        if rectangle and len(values) <= count_values:
+            result = count_majority(window_image, footprint.shape, values)
+        else:
+            result = majority(window_image, footprint)
+        return result[
+            tile[0].start - row0 : tile[0].stop - row0,
+            tile[1].start - col0 : tile[1].stop - col0,
+        ]
+
+    # the rank filter releases the GIL while filtering, results are written
+    # to out from this thread (tiles do not overlap)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for tile, result in zip(tiles, executor.map(filter_tile, tiles)):
+            tile_mask = mask[tile]
+            out[tile][tile_mask] = result[tile_mask]
+
+
 def bbox2gdf(bbox):
     p1 = Point(bbox[0], bbox[3])
     p2 = Point(bbox[2], bbox[3])
@@ -17,12 +17,13 @@ with open("becmodel/__init__.py", "r") as f:
 
 requires = [
     "bcdata",
-    "click",
-    "fiona",
+    "click>=8.0",
     "gdal",
-    "geopandas",
-    "geojson",
+    "geopandas>=0.12",
+    "pyogrio>=0.6",
+    "pyarrow",
     "numpy",
+    "shapely>=2.0",
     "pandas",
     "rasterio",
     "scikit-image",
@@ -43,8 +44,6 @@ setup(
         "Intended Audience :: Developers",
         "License :: OSI Approved :: Apache",
         "Operating System :: OS Independent",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
     ],
     keywords='BEC Biogeoclimatic Ecosystem Classification "Britsh Columbia"',
@@ -54,8 +53,9 @@ setup(
     packages=find_packages(exclude=["ez_setup", "examples", "tests"]),
     include_package_data=True,
     zip_safe=False,
+    python_requires=">=3.8",
     install_requires=requires,
-    extras_require={"test": ["pytest"]},
+    extras_require={"test": ["pytest", "fiona"]},
     entry_points="""
       [console_scripts]
       becmodel=becmodel.cli:cli
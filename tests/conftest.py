@@ -0,0 +1,13 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path_factory, monkeypatch):
+    """Point the user home folder to a temp folder, so that the becmodel
+    caches (parsed configs, buffered neighbours) are never written to the
+    user's ~/.cache
+    """
+    path = str(tmp_path_factory.mktemp("home"))
+    monkeypatch.setenv("HOME", path)
+    monkeypatch.setenv("USERPROFILE", path)
+    return path
@@ -1,12 +1,17 @@
+import configparser
+import logging
 import os
 
 import pytest
+from click.testing import CliRunner
+import numpy as np
 import pandas as pd
 import fiona
 import geopandas as gpd
 
 from becmodel import BECModel
 from becmodel import util
+from becmodel.cli import cli
 from becmodel.main import ConfigError, ConfigValueError
 from becmodel.util import DataValueError
 
@@ -18,6 +23,117 @@ def test_align():
     assert util.align(bounds) == (1445887.5, 467287.5, 1463387.5, 489087.5)
 
 
+def test_dem_to_int16():
+    dem = np.array(
+        [[100.7, -3.4028235e38, np.nan], [40000, 525.2, -9999]], dtype=np.float32
+    )
+    low = np.iinfo(np.int16).min
+    expected = np.array([[100, low, low], [low, 525, low]], dtype=np.int16)
+    result = util.dem_to_int16(dem, nodata=-9999)
+    assert result.dtype == np.int16
+    assert (result == expected).all()
+
+
+def test_assign_by_rule():
+    image = np.array([[1, 1, 1], [2, 2, 2]], dtype=np.uint16)
+    ruleimg = np.array([[10, 10, 20], [20, 30, 30]], dtype=np.uint16)
+    mask = np.array([[True, False, True], [True, True, False]])
+    util.assign_by_rule(image, mask, ruleimg, {10: 5, 20: 6})
+    assert image.tolist() == [[5, 1, 6], [6, 2, 2]]
+
+
+def test_assign_by_rule_and_value():
+    image = np.array([[1, 2, 1], [2, 2, 1]], dtype=np.uint16)
+    ruleimg = np.array([[10, 10, 20], [20, 30, 30]], dtype=np.uint16)
+    util.assign_by_rule_and_value(image, ruleimg, {(10, 1): 5, (20, 2): 6, (30, 1): 7})
+    assert image.tolist() == [[5, 2, 1], [6, 2, 7]]
+
+
+def test_remove_noise():
+    from scipy import ndimage
+
+    # a hole of 1 cell is filled, an object of 1 cell is removed and an
+    # object of exactly threshold (3) cells is kept
+    mask = np.array(
+        [
+            [0, 0, 0, 0, 0, 0, 0],
+            [0, 1, 1, 1, 0, 0, 0],
+            [0, 1, 0, 1, 0, 0, 0],
+            [0, 1, 1, 1, 0, 1, 0],
+            [0, 0, 0, 0, 0, 0, 0],
+            [0, 1, 1, 0, 0, 0, 0],
+            [0, 1, 0, 0, 0, 0, 0],
+        ],
+        dtype=bool,
+    )
+    expected = np.array(
+        [
+            [0, 0, 0, 0, 0, 0, 0],
+            [0, 1, 1, 1, 0, 0, 0],
+            [0, 1, 1, 1, 0, 0, 0],
+            [0, 1, 1, 1, 0, 0, 0],
+            [0, 0, 0, 0, 0, 0, 0],
+            [0, 1, 1, 0, 0, 0, 0],
+            [0, 1, 0, 0, 0, 0, 0],
+        ],
+        dtype=bool,
+    )
+    for connectivity in (1, 2):
+        structure = ndimage.generate_binary_structure(2, connectivity)
+        assert (util.remove_noise(mask, 3, structure) == expected).all()
+
+    # diagonal cells are 3 objects of 1 cell with connectivity 1, but a
+    # single object of 3 cells with connectivity 2
+    mask = np.eye(4, dtype=bool)
+    mask[3, 3] = False
+    structure = ndimage.generate_binary_structure(2, 1)
+    assert not util.remove_noise(mask, 3, structure).any()
+    structure = ndimage.generate_binary_structure(2, 2)
+    assert (util.remove_noise(mask, 3, structure) == mask).all()
+
+
+def test_small_holes():
+    from scipy import ndimage
+
+    # two diagonal holes of 1 cell are small (< 2 cells) with connectivity 1,
+    # with connectivity 2 they are a single hole of 2 cells and are kept
+    mask = np.ones((5, 5), dtype=bool)
+    mask[1, 1] = mask[2, 2] = False
+    structure = ndimage.generate_binary_structure(2, 1)
+    assert (util.small_holes(mask, 2, structure) == ~mask).all()
+    structure = ndimage.generate_binary_structure(2, 2)
+    assert not util.small_holes(mask, 2, structure).any()
+
+
+def test_count_majority():
+    image = np.array(
+        [[0, 0, 1, 1], [0, 2, 1, 1], [2, 2, 2, 1], [0, 2, 1, 1]], dtype=np.uint8
+    )
+    # ties (eg the 0/2 tie at row 1, column 0) resolve to the lowest value
+    expected = np.array(
+        [[0, 0, 1, 1], [0, 2, 1, 1], [2, 2, 1, 1], [2, 2, 1, 1]], dtype=np.uint8
+    )
+    assert (util.count_majority(image, (3, 3), np.arange(3)) == expected).all()
+    # even sizes extend one cell further up / left than down / right
+    expected = np.array(
+        [[0, 0, 0, 1], [0, 0, 1, 1], [0, 2, 2, 1], [0, 2, 2, 1]], dtype=np.uint8
+    )
+    assert (util.count_majority(image, (2, 2), np.arange(3)) == expected).all()
+
+
+def test_configure_logging(monkeypatch):
+    root = logging.getLogger()
+    existing = logging.NullHandler()
+    monkeypatch.setattr(root, "handlers", [existing])
+    monkeypatch.setattr(util, "_log_handler", None)
+    monkeypatch.setattr(root, "level", root.level)
+    util.configure_logging(1)
+    util.configure_logging(1)
+    # an already configured root logger does not get a second handler
+    assert root.handlers == [existing]
+    assert root.level == logging.DEBUG
+
+
 def test_invalid_config():
     with pytest.raises(ConfigError):
         BM = BECModel("tests/test_invalid_config.cfg")
@@ -28,6 +144,87 @@ def test_valid_config():
     assert BM.config["rulepolys_file"] == "tests/data/data.gdb.zip"
 
 
+def test_load_key():
+    BM = BECModel(TESTCONFIG)
+    BM.data["bounds"] = (0, 0, 1, 1)
+    key = BM.load_key
+    assert BM.load_key == key
+    # editing rule polygon features changes the key
+    BM.data["rulepolys"] = BM.data["rulepolys"].set_geometry(
+        BM.data["rulepolys"].translate(10, 0)
+    )
+    assert BM.load_key != key
+
+
+def test_load_config_cache(monkeypatch):
+    monkeypatch.delenv("BECMODEL_CONFIG_CACHE", raising=False)
+    config = util.load_config(TESTCONFIG)
+    assert len(os.listdir(util.cache_dir())) == 1
+    assert util.load_config(TESTCONFIG) == config
+    assert config["cell_size_metres"] == 50
+    # configs cached by another version are not reused
+    monkeypatch.setattr(util, "__version__", "0.0.0")
+    assert util.load_config(TESTCONFIG) == config
+    assert len(os.listdir(util.cache_dir())) == 2
+
+
+def test_parse_config():
+    config = util.parse_config(
+        {"cell_size_metres": "25", "high_elevation_removal_threshold_parkland": "p,s"}
+    )
+    assert config["cell_size_metres"] == 25
+    assert config["high_elevation_removal_threshold_parkland"] == ("p", "s")
+    with pytest.raises(ConfigError):
+        util.parse_config({"cell_size": 25})
+
+
+def test_load_neighbours():
+    # bbox straddling the BC / Alberta border near Jasper
+    assert not util.load_neighbours((-118.5, 52.5, -117.5, 53.5)).empty
+    assert os.listdir(util.cache_dir()) == [
+        "neighbours-buffered-v{}.fgb".format(util.NEIGHBOURS_CACHE_VERSION)
+    ]
+    # bbox in central BC
+    assert util.load_neighbours((-124.0, 53.5, -123.5, 54.0)).empty
+
+
+def test_load_neighbours_uncached(home):
+    # an unwritable cache falls back to the uncached neighbours
+    open(os.path.join(home, ".cache"), "w").close()
+    assert not util.load_neighbours((-118.5, 52.5, -117.5, 53.5)).empty
+
+
+def test_config_dict():
+    BM = BECModel(util.load_config(TESTCONFIG))
+    assert BM.config["rulepolys_file"] == "tests/data/data.gdb.zip"
+
+
+def test_config_empty_dict():
+    # an empty config is validated (the default input paths do not exist here)
+    with pytest.raises(ConfigValueError):
+        BECModel({})
+
+
+def test_write_config_log(tmpdir, monkeypatch):
+    config = util.load_config(TESTCONFIG)
+    del config["temp_folder"]
+    BM = BECModel(config)
+    # load() creates the temp folder when it is not specified
+    BM.config["temp_folder"] = str(tmpdir.join("becmodel-temp"))
+    monkeypatch.chdir(tmpdir)
+    BM.write_config_log()
+    (config_log,) = tmpdir.listdir("becmodel-config-log_*.txt")
+    configlog = configparser.ConfigParser()
+    configlog.read(str(config_log))
+    assert configlog["3_DEFAULT"]["temp_folder"] == str(tmpdir.join("becmodel-temp"))
+
+
+def test_cli_dry_run():
+    result = CliRunner().invoke(cli, ["--dry-run", TESTCONFIG])
+    assert result.exit_code == 0
+    assert "validation successful" in result.output
+
+
 def test_config_data_missing():
     with pytest.raises(ConfigValueError):
         BM = BECModel(TESTCONFIG)
@@ -52,6 +249,21 @@ def test_reproject_rule_layer():
     assert BM.data["rulepolys"].crs == "EPSG:3005"
 
 
+def test_aspect_lut():
+    BM = BECModel(TESTCONFIG)
+    steps = BM.aspect_steps
+    # cool zone midpoint 0, first step spans 355-5 degrees
+    assert steps["aspect_min"][0] == 355
+    assert steps["aspect_max"][0] == 5
+    assert BM.aspect_lut[355] == 0
+    assert BM.aspect_lut[4] == 0
+    assert BM.aspect_lut[360] == 0
+    # neutral east midpoint 90, first step of 2nd transition spans 85-95
+    assert steps["transition"][BM.aspect_lut[85]] == 1
+    assert steps["step"][BM.aspect_lut[85]] == 0
+    assert BM.aspect_lut[94] == BM.aspect_lut[85]
+
+
 def test_invalid_cell_size1():
     with pytest.raises(ConfigValueError):
         BM = BECModel(TESTCONFIG)
@@ -171,6 +383,16 @@ def test_local_dem(tmpdir):
     BM.load()
 
 
+def test_corrupt_dem(tmpdir):
+    dempath = os.path.join(str(tmpdir), "dem_corrupt.tif")
+    with open(dempath, "w") as f:
+        f.write("not a tiff")
+    BM = BECModel(TESTCONFIG)
+    BM.update_config({"dem": dempath})
+    with pytest.raises(DataValueError):
+        BM.load()
+
+
 def test_run_gpkg(tmpdir):
     """
     Check that gpkg outputs are created, properly structured and consistent